@@ -1,5 +1,8 @@
-from datetime import date, timedelta
-from dateutil.relativedelta import relativedelta
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import date
+from functools import lru_cache
+from itertools import combinations
 
 DAYS = {
     1: "Lu",
@@ -32,107 +35,288 @@ def date_repr(d):
     return f"{d}-{day_str}"
 
 
+@lru_cache(maxsize=1024)
+def _parse(value):
+    return date.fromisoformat(value)
+
+
 def to_date(value):
     if isinstance(value, date):
         return value
     elif isinstance(value, str):
-        return date.fromisoformat(value)
+        return _parse(value)
     raise ValueError
 
 
 class DR:
+    __slots__ = ("start", "end", "_s", "_e")
+
     def __init__(self, start, end):
         self.start = to_date(start)
         self.end = to_date(end)
         assert self.start <= self.end
+        self._s, self._e = self.start.toordinal(), self.end.toordinal()
+
+    @classmethod
+    def _from_ords(cls, s, e):
+        # trusted ordinals, skips parsing and checks
+        self = object.__new__(cls)
+        self._s, self._e = s, e
+        self.start = date.fromordinal(s)
+        self.end = date.fromordinal(e)
+        return self
 
     @property
     def days(self):
-        td = self.end - self.start
-        return td.days
+        return self._e - self._s
 
     def __contains__(self, d):
         assert isinstance(d, date)
-        return self.start <= d and d <= self.end
+        return self._s <= d.toordinal() <= self._e
 
     def overlap(self, dr):
-        return self.start <= dr.end and dr.start <= self.end
+        return self._s <= dr._e and dr._s <= self._e
 
     def __repr__(self):
         return f"{date_repr(self.start)} - {date_repr(self.end)}"
 
 
+def build_constraint_segtree(c_starts, c_ends):
+    # segment tree over half-open [start, end + 1) ordinals, leaves are the
+    # elementary intervals between consecutive endpoints and each node keeps
+    # the indices of the constraints it canonically covers
+    bounds = sorted(set(c_starts) | set(e + 1 for e in c_ends))
+    nodes = [[] for _ in range(4 * len(bounds))]
+
+    def insert(node, lo, hi, start, end, key):
+        if end <= bounds[lo] or bounds[hi] <= start:
+            return
+        if start <= bounds[lo] and bounds[hi] <= end:
+            nodes[node].append(key)
+            return
+        mid = (lo + hi) // 2
+        insert(2 * node, lo, mid, start, end, key)
+        insert(2 * node + 1, mid, hi, start, end, key)
+
+    for key, (start, end) in enumerate(zip(c_starts, c_ends)):
+        insert(1, 0, len(bounds) - 1, start, end + 1, key)
+    return bounds, nodes
+
+
+def query_constraint_segtree(segtree, start, end):
+    bounds, nodes = segtree
+    if len(bounds) < 2:
+        return
+    end += 1
+    stack = [(1, 0, len(bounds) - 1)]
+    while stack:
+        node, lo, hi = stack.pop()
+        if end <= bounds[lo] or bounds[hi] <= start:
+            continue
+        yield from nodes[node]
+        if hi - lo > 1:
+            mid = (lo + hi) // 2
+            stack.append((2 * node, lo, mid))
+            stack.append((2 * node + 1, mid, hi))
+
+
+def _consistency_sweep(starts, ends):
+    # sort once by start, each interval can then only overlap the ones
+    # following it until their start passes its end
+    order = sorted(range(len(starts)), key=starts.__getitem__)
+    pairs = []
+    for i, idx in enumerate(order):
+        end = ends[idx]
+        for j in range(i + 1, len(order)):
+            other_idx = order[j]
+            if starts[other_idx] > end:
+                break
+            pairs.append((idx, other_idx))
+    return pairs
+
+
+def _match_constraints(g_starts, g_ends, g_who, c_starts, c_ends, c_who):
+    segtree = build_constraint_segtree(c_starts, c_ends)
+    pairs = set()
+    for g_idx, (start, end) in enumerate(zip(g_starts, g_ends)):
+        for c_idx in query_constraint_segtree(segtree, start, end):
+            if c_who[c_idx] == g_who[g_idx]:
+                pairs.add((g_idx, c_idx))
+    return sorted(pairs)
+
+
+def _run_scenario(g_starts, g_ends, g_who, c_starts, c_ends, c_who):
+    # whole per-scenario pipeline: overlapping gardes, then gardes hitting
+    # constraints of the same person
+    return (
+        _consistency_sweep(g_starts, g_ends),
+        _match_constraints(g_starts, g_ends, g_who, c_starts, c_ends, c_who),
+    )
+
+
 class Scenario:
+    __slots__ = (
+        "name",
+        "_who",
+        "_who_codes",
+        "_who_names",
+        "_starts",
+        "_ends",
+        "_by_who",
+        "_max_days",
+        "_days_by_who",
+    )
+
     def __init__(self, name):
         self.name = name
-        self.gardes = []
+        # gardes are stored as parallel arrays (who code, start/end ordinals)
+        self._who = array('b')
+        self._who_codes = {}
+        self._who_names = []
+        self._starts = array('i')
+        self._ends = array('i')
+        # (start, end) ordinals of each person's gardes, sorted by start
+        self._by_who = {}
+        self._max_days = 0
+        self._days_by_who = {}
+
+    @property
+    def gardes(self):
+        return [
+            Garde(self._who_names[code], DR._from_ords(s, e))
+            for code, s, e in zip(self._who, self._starts, self._ends)
+        ]
+
+    def _code(self, who):
+        code = self._who_codes.get(who)
+        if code is None:
+            code = self._who_codes[who] = len(self._who_names)
+            self._who_names.append(who)
+        return code
 
     @property
     def people(self):
-        return list(set([g.who for g in self.gardes]))
+        return list(self._days_by_who)
 
     @property
     def nb_days_by_people(self):
-        days_by_people = {}
-        for who in self.people:
-            days = 0
-            for g in self.gardes:
-                if g.who == who:
-                    days += g.days
-            days_by_people[who] = days
-        return days_by_people
+        return dict(self._days_by_who)
 
     def add(self, who, start, end):
-        g = Garde(who, DR(start, end))
-        self.gardes.append(g)
+        dr = DR(start, end)
+        self.extend((dr._s,), (dr._e,), (self._code(who),))
+
+    def extend(self, starts, ends, who_codes):
+        self._who.extend(who_codes)
+        self._starts.extend(starts)
+        self._ends.extend(ends)
+        for code, s, e in zip(who_codes, starts, ends):
+            who = self._who_names[code]
+            self._days_by_who[who] = self._days_by_who.get(who, 0) + e - s
+            insort(self._by_who.setdefault(code, []), (s, e))
+            self._max_days = max(self._max_days, e - s)
 
     def overlap(self, who, dr):
-        for g in self.gardes:
-            if g.who == who and g.dr.overlap(dr):
+        intervals = self._by_who.get(self._who_codes.get(who), [])
+        # a garde overlapping dr starts at most _max_days before dr and no
+        # later than its end, walk back from the last one starting in time
+        lowest_start = dr._s - self._max_days
+        i = bisect_left(intervals, (dr._e + 1,)) - 1
+        while i >= 0 and intervals[i][0] >= lowest_start:
+            if intervals[i][1] >= dr._s:
                 return True
+            i -= 1
         return False
 
+    def _report_overlaps(self, pairs):
+        if pairs:
+            gardes = self.gardes
+            for g_idx, other_idx in pairs:
+                print('ERROR overlap', gardes[g_idx], gardes[other_idx])
+        return not pairs
+
+    def _constraint_codes(self, c_who):
+        for who in set(c_who):
+            assert who in self._days_by_who
+        return [self._who_codes[who] for who in c_who]
+
+    def _incompatibilites(self, c_who, c_list, pairs):
+        incompatibilites = {who: [] for who in c_who}
+        for c_idx in sorted(set(c_idx for _, c_idx in pairs)):
+            incompatibilites[c_who[c_idx]].append(c_list[c_idx])
+        return incompatibilites
+
     def check_consistency(self):
-        for g in self.gardes:
-            for other_g in self.gardes:
-                if other_g != g and other_g.dr.overlap(g.dr):
-                    print('ERROR overlap', g, other_g)
-                    return False
-        return True
+        return self._report_overlaps(_consistency_sweep(self._starts, self._ends))
     
     def check_constraints(self, constraints):
-        incompatibilites = {}
-        for who in constraints:
-            assert who in self.people
-            incompatibilites[who] = []
-        for who, c_list in constraints.items():
-            for c in c_list:
-                if self.overlap(who, c.dr):
-                    incompatibilites[who].append(c)
+        incompatibilites = {who: [] for who in constraints}
+        incompatibilites.update(
+            self.check_constraints_flat(*_flatten_constraints(constraints))
+        )
         return incompatibilites
 
+    def check_constraints_flat(self, c_who, c_starts, c_ends, c_list):
+        pairs = _match_constraints(
+            self._starts,
+            self._ends,
+            self._who,
+            c_starts,
+            c_ends,
+            self._constraint_codes(c_who),
+        )
+        return self._incompatibilites(c_who, c_list, pairs)
+
+    def check(self, c_who, c_starts, c_ends, c_list):
+        overlap_pairs, incompat_pairs = _run_scenario(
+            self._starts,
+            self._ends,
+            self._who,
+            c_starts,
+            c_ends,
+            self._constraint_codes(c_who),
+        )
+        return (
+            self._report_overlaps(overlap_pairs),
+            self._incompatibilites(c_who, c_list, incompat_pairs),
+        )
+
     def __repr__(self):
         return f"{self.gardes}"
 
     def merge(self, other_scenario):
-        assert len(self.people) == 0 or self.people == other_scenario.people
-        new_gardes = self.gardes
-        for other_garde in other_scenario.gardes:
-            assert not self.overlap(other_garde.who, other_garde.dr)
-            new_gardes.append(other_garde)
-        self.gardes = new_gardes
+        assert (
+            len(self._days_by_who) == 0
+            or self._days_by_who.keys() == other_scenario._days_by_who.keys()
+        )
+        # translate the other scenario's who codes into ours
+        codes = [self._code(who) for who in other_scenario._who_names]
+        other_who = array('b', [codes[code] for code in other_scenario._who])
+        intervals_by_who = {}
+        for code, s, e in zip(
+            self._who + other_who,
+            self._starts + other_scenario._starts,
+            self._ends + other_scenario._ends,
+        ):
+            starts, ends = intervals_by_who.setdefault(code, ([], []))
+            starts.append(s)
+            ends.append(e)
+        for starts, ends in intervals_by_who.values():
+            assert not _consistency_sweep(starts, ends)
+        self.extend(other_scenario._starts, other_scenario._ends, other_who)
 
 
 def scenario_repr(s, year):
+    # first day of each month plus January 1st of the next year
+    month_starts = [date(year, month, 1).toordinal() for month in range(1, 12+1)]
+    month_starts.append(date(year + 1, 1, 1).toordinal())
+    buckets = [[] for _ in range(12 + 2)]
+    for g in s.gardes:
+        buckets[bisect_right(month_starts, g.dr._s)].append(g)
     repr = ""
     for month in range(1, 12+1):
         m_str = MONTHS[month]
-        m_start = date(year=year, month=month, day=1)
-        m_dr = DR(m_start, m_start + relativedelta(months=1))
-        month_gardes = []
-        for g in s.gardes:
-            if g.dr.start in m_dr:
-                month_gardes.append(g)
+        month_gardes = buckets[month]
         repr_gardes = " - ".join(
             [f"{g.who}({g.dr.start.day}-{g.dr.end.day})" for g in month_gardes]
         )
@@ -141,6 +325,8 @@ def scenario_repr(s, year):
 
 
 class Garde:
+    __slots__ = ("who", "dr")
+
     def __init__(self, who, dr):
         self.who = who
         self.dr = dr
@@ -154,33 +340,43 @@ class Garde:
 
 
 class Constraint:
+    __slots__ = ("name", "dr")
+
     def __init__(self, name, start, end):
         self.name = name
         self.dr = DR(start, end)
 
     def overlap(self, other_c):
-        return self.dr.overlap(other_c.dr)
+        dr, other_dr = self.dr, other_c.dr
+        return dr._s <= other_dr._e and other_dr._s <= dr._e
 
     def __repr__(self):
         return f"{self.name} - {self.dr}"
 
 
+def _flatten_constraints(constraints):
+    c_who, c_starts, c_ends, c_list = [], array('i'), array('i'), []
+    for who, cs in constraints.items():
+        for c in cs:
+            c_who.append(who)
+            c_starts.append(c.dr._s)
+            c_ends.append(c.dr._e)
+            c_list.append(c)
+    return c_who, c_starts, c_ends, c_list
+
+
 def create_simple_scenario(name, start, end, who_starts, who_other):
     start = to_date(start)
     assert start.isoweekday() == 5  # Friday
     end = to_date(end)
     assert start <= end
-    week = timedelta(days=7)
     scenario = Scenario(name)
-    d = start
-    who = who_starts
-    while d < end:
-        scenario.add(who, d, d + week - timedelta(days=1))
-        d += week
-        if who == who_starts:
-            who = who_other
-        else:
-            who = who_starts
+    # one week per Friday, alternating between both people
+    codes = (scenario._code(who_starts), scenario._code(who_other))
+    starts = array('i', range(start.toordinal(), end.toordinal(), 7))
+    ends = array('i', [s + 6 for s in starts])
+    who_codes = array('b', [codes[i % 2] for i in range(len(starts))])
+    scenario.extend(starts, ends, who_codes)
     return scenario
 
 
@@ -217,6 +413,8 @@ if __name__ == "__main__":
         ],
     }
 
+    C_WHO, C_S, C_E, C_LIST = _flatten_constraints(CONTRAINTES)
+
     # Divers scenarios de garde
     SCENARIOS = [
         create_simple_scenario(
@@ -259,13 +457,16 @@ if __name__ == "__main__":
     print("******************************************************************")
     print("Contraintes incompatibles")
     print("******************************************************************")
-    for who, c_list in CONTRAINTES.items():
-        for c in c_list:
-            for other_who, other_c_list in CONTRAINTES.items():
-                if other_who != who:
-                    for other_c in other_c_list:
-                        if c.overlap(other_c):
-                            print(f"{who}({c}) / {other_who}({other_c})")
+    for (who, c_list), (other_who, other_c_list) in combinations(
+        CONTRAINTES.items(), 2
+    ):
+        # only constraints ending after other_c starts can overlap it
+        c_list = sorted(c_list, key=lambda c: c.dr._e)
+        c_ends = [c.dr._e for c in c_list]
+        for other_c in other_c_list:
+            for i in range(bisect_left(c_ends, other_c.dr._s), len(c_list)):
+                if c_list[i].dr._s <= other_c.dr._e:
+                    print(f"{who}({c_list[i]}) / {other_who}({other_c})")
     print()
 
     # check incompatibilites for each scenario
@@ -283,10 +484,9 @@ if __name__ == "__main__":
         print()
 
         print('Vérification de cohérence:')
-        s.check_consistency()
+        _, incompatibilites = s.check(C_WHO, C_S, C_E, C_LIST)
         print()
 
-        incompatibilites = s.check_constraints(CONTRAINTES)
         print(
             f"Incompatibilités: B({len(incompatibilites['B'])}) C({len(incompatibilites['C'])})"
         )